@@ -1,18 +1,29 @@
 # Build the top-open-subtitles-sentences repository
 
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
 import os
 import shutil
+import csv
 import sys
 import time
+import threading
 import zipfile
-import gzip
 import re
 import itertools
-from collections import Counter
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
 import requests
+try:
+    # faster decompression of the "text" and "tokenized" data if available
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
 
 ###############################################################################
@@ -48,9 +59,13 @@ year_max = 2018   # largest: 2018
 
 # performance
 download_chunk_size = 1000000
+n_download_connections = 4
+write_buffer_size = 16*1024*1024
 min_count = 5
 lines_per_chunk = 10000000
+min_count_prefilter = False
 n_process = 6
+n_parallel_langcodes = 1
 
 # finetuning
 original_language_only = False
@@ -58,8 +73,9 @@ one_subtitle_per_movie = False
 use_regex_tokenizer = False
 regex_tokenizer_pattern = r"\w+|[^\w\s]+"
 linestrip_pattern = " /-–\n\t\""
-lowcase_cutoff = 0.08 # set to 0.5 to get words faster
+lowcase_cutoff = 0.08
 md_summary_table = True
+parquet_summary_table = False
 
 # output settings
 n_top_sentences = 10000
@@ -84,17 +100,28 @@ n_top_words = 30000
 
 # Memory requirements:
 # With raw data, langcode = "en", year_min = 0, and year_max = 2018, the corpus
-# is parsed into a file of 13GB. This file is then loaded 'lines_per_chunk'
-# lines at a time into a Counter (dict subclass) object which at its peak takes
-# 26GB of memory. By setting 'min_count', entries with count less than that can
-# be omitted to save memory, but this only happens after the whole tempfile has
-# been loaded (otherwise the final counts would not be correct).
+# is parsed into a file of 13GB. This file is then counted 'lines_per_chunk'
+# lines at a time, with the counts merged into a pyarrow table holding each
+# distinct sentence/word once (with a Python Counter this took 26GB at its
+# peak). By setting 'min_count', entries with count less than that can be
+# omitted to save memory, but this only happens after the whole tempfile has
+# been loaded (otherwise the final counts would not be correct). To avoid this
+# for sentences, set 'min_count_prefilter' to 'True'. The tempfile is then
+# first read to count sentences approximately in a fixed-size Count-Min
+# sketch, and only sentences which might reach 'min_count' are counted exactly
+# when reading it a second time. The sketch takes 1GB if 'min_count' is below
+# 256 and 2GB if it is below 65536 (see 'count_min_sketch_shape').
+# With 'n_parallel_langcodes' larger than 1, that many languages are run at
+# the same time, each needing its own memory and 'n_process' processes.
 
 # Download time:
 # Variable 'download_chunk_size' influences the download time. The default
 # works well with a bandwidth of 50MB/s, bringing the download speed close to
 # that. The zipped raw corpus for a large language like "en" is around 13GB
-# and hence takes around 4 minutes to download at that rate.
+# and hence takes around 4 minutes to download at that rate. With
+# 'n_download_connections' larger than 1, the file is downloaded in that many
+# parts at once, which helps when a single connection can not use the full
+# bandwidth.
 
 # Runtime:
 # Runtime excluding data download (on M1 MBP) with the default settings:
@@ -144,6 +171,37 @@ non_latin_langs = ['ar', 'bg', 'bn', 'el', 'fa', 'he', 'hi', 'hy', 'ja', 'ka',
                    'kk', 'ko', 'mk', 'ml', 'ru', 'si', 'ta', 'te', 'th', 'uk',
                    'ur', 'ze_zh', 'zh_cn', 'zh_tw']
 
+# 'linestrip_pattern' for lines of the raw subtitle xml files, which are
+# processed as bytes. The ASCII characters are stripped with bytes.strip().
+# Multi-byte characters like '–' can not be, as their single bytes would also
+# cut into other UTF-8 encoded characters; lines starting or ending with one
+# of them are stripped with 'linestrip_bytes_regex' instead.
+linestrip_bytes = "".join(c for c in linestrip_pattern
+                          if c.isascii()).encode('utf-8')
+linestrip_multibyte = tuple(c.encode('utf-8') for c in linestrip_pattern
+                            if not c.isascii())
+linestrip_bytes_regex = re.compile(
+    rb"(?:" + b"|".join(re.escape(c.encode('utf-8'))
+                        for c in linestrip_pattern)
+    + rb")*(.*?)(?:" + b"|".join(re.escape(c.encode('utf-8'))
+                                 for c in linestrip_pattern)
+    + rb")*", re.S)
+
+original_regex = re.compile(rb"<original>(.*?)</original>")
+
+tokenizer_regex = re.compile(regex_tokenizer_pattern)
+
+# Patterns of entries removed from the sentence and word counts. These are
+# matched by pyarrow (RE2 syntax, where '\W' would only cover ASCII).
+punctuation_and_numbers_regex = r"^(?:[^\p{L}\p{N}]|[0-9])+$"
+parenthesis_start_regex = r"^[(\[{]"
+colon_end_regex = r":$"
+latin_regex = "[a-zA-Zà-üÀ-Ü]"
+
+# rows and columns of the sketch used with 'min_count_prefilter' (1GB with
+# 'min_count' below 256, 2GB below 65536)
+count_min_sketch_shape = (4, 2**28)
+
 def source_zipfile(langcode, source_data_type):
     url_base = "https://object.pouta.csc.fi/OPUS-OpenSubtitles/"
     if source_data_type == "raw":
@@ -182,8 +240,8 @@ def extra_sentences_to_exclude():
     return (pd.read_csv(f"src/extra_settings/extra_sentences_to_exclude.csv")
             .to_dict('list'))
 
-total_counts_sentences_file = "bld/total_counts_sentences.csv"
-total_counts_words_file = "bld/total_counts_words.csv"
+total_counts_sentences_file = "bld/total_counts_sentences.tsv"
+total_counts_words_file = "bld/total_counts_words.tsv"
 
 
 ###############################################################################
@@ -191,40 +249,101 @@ total_counts_words_file = "bld/total_counts_words.csv"
 
 def download_data_and_extract(basedatadir, langcode, source_data_type):
     print("Downloading data:")
-    if not os.path.exists(basedatadir):
-        os.makedirs(basedatadir)
+    os.makedirs(basedatadir, exist_ok=True)
     f = download_data_file(source_zipfile(langcode, source_data_type),
                            basedatadir, langcode)
     extension = os.path.splitext(f)[1]
     if source_data_type in ["text", "tokenized"]:
         with gzip.open(f, 'rb') as f_in:
-            with open(parsedfile(langcode, source_data_type), 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            with open(parsedfile(langcode, source_data_type), 'wb',
+                      buffering=write_buffer_size) as f_out:
+                shutil.copyfileobj(f_in, f_out, length=1024*1024)
     else:
-        with zipfile.ZipFile(f, 'r') as zip_ref:
-            #zip_ref.extractall(os.path.join(basedatadir, f"{langcode}"))
-            zip_ref.extractall(os.path.join(basedatadir, f"{langcode}/raw"))
+        extract_zipfile(f, os.path.join(basedatadir, f"{langcode}/raw"))
     os.remove(f)
 
 
+def extract_zipfile(file_path, outdir):
+    # zlib releases the GIL while inflating, so members can be extracted in
+    # parallel threads sharing one ZipFile. Files are grouped by directory
+    # so that no two threads try to create the same directory.
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        members = zip_ref.infolist()
+        zip_ref.extractall(outdir, members=[m for m in members if m.is_dir()])
+        members_by_dir = {}
+        for m in members:
+            if not m.is_dir():
+                (members_by_dir.setdefault(os.path.dirname(m.filename), [])
+                 .append(m))
+        extract_func = partial(extract_members, zip_ref, outdir=outdir)
+        with ThreadPoolExecutor(max_workers=n_process) as executor:
+            list(executor.map(extract_func, members_by_dir.values()))
+
+
+def extract_members(zip_ref, members, outdir):
+    for m in members:
+        zip_ref.extract(m, outdir)
+
+
 def download_data_file(url, basedatadir, langcode):
     extension = os.path.splitext(url)[1]
     local_filename = os.path.join(basedatadir, f"{langcode}{extension}")
-    with requests.get(url, stream=True) as r:
+    with requests.head(url, allow_redirects=True) as r:
         r.raise_for_status()
         total_length = int(r.headers.get('content-length'))
-        print(f"   downloading {total_length/1e6:.1f} MB...")
-        print_period = max(round(total_length/download_chunk_size/10), 1)        
-        download_length = 0
-        i = 1
-        with open(local_filename, 'wb') as f:
+        accepts_ranges = r.headers.get('accept-ranges') == 'bytes'
+    print(f"   downloading {total_length/1e6:.1f} MB...")
+
+    # A single connection is limited by TCP slow start, so if possible the
+    # file is downloaded in parts over several connections at once.
+    n_parts = n_download_connections if accepts_ranges else 1
+    part_length = max(-(-total_length // n_parts), 1)
+    parts = [(start, min(start + part_length, total_length) - 1)
+             for start in range(0, total_length, part_length)]
+    with open(local_filename, 'wb') as f:
+        f.truncate(total_length)
+
+    lock = threading.Lock()
+    download_length = 0
+    print_share = 0.1
+    def report_progress(chunk_length):
+        nonlocal download_length, print_share
+        with lock:
+            download_length += chunk_length
+            if download_length/total_length >= print_share:
+                print(f"   {download_length/total_length*100:.0f}% done")
+                while download_length/total_length >= print_share:
+                    print_share += 0.1
+
+    download_func = partial(download_data_part, url, local_filename,
+                            report_progress=report_progress,
+                            ranged=(n_parts > 1))
+    with ThreadPoolExecutor(max_workers=n_parts) as executor:
+        list(executor.map(download_func, parts))
+    return local_filename
+
+
+def download_data_part(url, local_filename, part, report_progress, ranged):
+    start, end = part
+    headers = {"Range": f"bytes={start}-{end}"} if ranged else None
+    with requests.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if ranged and r.status_code != 206:
+            raise Exception(f"Error: Server did not return range {start}-"
+                            + f"{end} of {url}.")
+        part_length = 0
+        with open(local_filename, 'r+b') as f:
+            f.seek(start)
             for chunk in r.iter_content(chunk_size=download_chunk_size):
-                download_length += len(chunk)
                 f.write(chunk)
-                if i % print_period == 0:
-                    print(f"   {download_length/total_length*100:.0f}% done")
-                i += 1
-    return local_filename
+                part_length += len(chunk)
+                report_progress(len(chunk))
+    # the file was preallocated, so a cut-short part would otherwise leave
+    # a hole of zeros without any error
+    if part_length != end - start + 1:
+        raise Exception(f"Error: Received {part_length} of "
+                        + f"{end - start + 1} bytes of range {start}-{end} "
+                        + f"of {url}.")
 
 
 def parse_rawdatadir_to_tmpfile(langcode, rawdatadir, tmpfile,
@@ -233,53 +352,29 @@ def parse_rawdatadir_to_tmpfile(langcode, rawdatadir, tmpfile,
     print("Parsing data:")
     if os.path.exists(tmpfile):
         os.remove(tmpfile)
-    if not os.path.exists("bld/tmp"):
-        os.makedirs("bld/tmp")
-    global n_subfiles, n_original_info, n_matching_original
+    os.makedirs("bld/tmp", exist_ok=True)
     n_subfiles = 0
     n_original_info = 0
     n_matching_original = 0
     yeardatadir = os.path.join(rawdatadir, f"OpenSubtitles/raw/{langcode}")
-    fout = open(tmpfile, 'a', encoding='utf-8')
-    
-    with ProcessPoolExecutor(max_workers=n_process) as executor:
-        for ydir in os.listdir(yeardatadir):
-            if int(ydir) < year_min or int(ydir) > year_max:
-                continue
-
-            print(f"   {ydir}")
-            xml_files = []
-            for mdir in os.listdir(os.path.join(yeardatadir, ydir)):
-                mdirfull = os.path.join(yeardatadir, ydir, mdir)
-                if not os.path.isdir(mdirfull):
-                    continue
-                if one_subtitle_per_movie:
-                    # sort to make deterministic and take last
-                    fname = sorted([f for f in os.listdir(mdirfull)
-                                    if not f.startswith('.')])[-1]
-                    fpathfull = os.path.join(yeardatadir, ydir,
-                                                mdir, fname)
-                    n_subfiles += 1
-                    xml_files.append(fpathfull)
-                else:
-                    for fname in os.listdir(mdirfull):
-                        if fname.startswith('.'):
-                            continue
-                        fpathfull = os.path.join(yeardatadir, ydir,
-                                                    mdir, fname)
-                        n_subfiles += 1
-                        if original_language_only:
-                            if check_if_original(fpathfull,
-                                                    langcode):
-                                n_matching_original += 1
-                                xml_files.append(fpathfull)
-                        else:
-                            xml_files.append(fpathfull)
-                    
-            y_text = list(executor.map(text_from_xmlfile, xml_files))                    
-            fout.write("".join(y_text))
-
-    fout.close()
+    xml_files = xml_files_in_yeardatadir(yeardatadir, year_min, year_max)
+    # the original language is only checked when using all subtitle files
+    parse_func = partial(parse_xmlfile, langcode=langcode,
+                         check_original=(original_language_only
+                                         and not one_subtitle_per_movie))
+
+    # one pool for all years; results are written as soon as they arrive
+    with open(tmpfile, 'wb', buffering=write_buffer_size) as fout:
+        with multiprocessing.Pool(n_process) as pool:
+            for text, has_original_info, is_original in pool.imap_unordered(
+                    parse_func, xml_files, chunksize=256):
+                fout.write(text)
+                n_subfiles += 1
+                if n_subfiles % 50000 == 0:
+                    print(f"   {n_subfiles} files parsed")
+                n_original_info += has_original_info
+                n_matching_original += is_original
+
     parse_time = time.perf_counter() - start
     print(f"   {n_subfiles} files parsed in {parse_time:.1f} seconds")
     if original_language_only:
@@ -288,33 +383,69 @@ def parse_rawdatadir_to_tmpfile(langcode, rawdatadir, tmpfile,
               + "match original language")
 
 
-def check_if_original(infile, langcode):
-    global n_original_info
-    fin = open(infile, 'r', encoding='utf-8')
-    intext = fin.read()
-    fin.close()
-    m = re.search("<original>(.*?)</original>", intext)
+def xml_files_in_yeardatadir(yeardatadir, year_min, year_max):
+    for ydir in os.listdir(yeardatadir):
+        if int(ydir) < year_min or int(ydir) > year_max:
+            continue
+        with os.scandir(os.path.join(yeardatadir, ydir)) as mdirs:
+            for mdir in mdirs:
+                # the file type is known from the directory listing itself,
+                # so this does not need another stat call
+                if not mdir.is_dir(follow_symlinks=False):
+                    continue
+                if one_subtitle_per_movie:
+                    # take the last name to make it deterministic
+                    with os.scandir(mdir.path) as files:
+                        fname = max((f.name for f in files
+                                     if not f.name.startswith('.')),
+                                    default=None)
+                    if fname is not None:
+                        yield os.path.join(mdir.path, fname)
+                else:
+                    with os.scandir(mdir.path) as files:
+                        for f in files:
+                            if not f.name.startswith('.'):
+                                yield f.path
+
+
+def parse_xmlfile(infile, langcode, check_original):
+    with open(infile, 'rb') as fin:
+        intext = fin.read()
+    has_original_info = False
+    is_original = False
+    if check_original:
+        has_original_info, is_original = check_if_original(intext, langcode)
+        if not is_original:
+            return b"", has_original_info, is_original
+    return text_from_xml(intext), has_original_info, is_original
+
+
+def check_if_original(intext, langcode):
+    m = original_regex.search(intext)
     if m:
-        n_original_info += 1
         #print(f"     {m.group(1)}")
-        if languages[langcode].split(",")[0] in m.group(1):
-            return True
-        else:
-            return False
+        language = languages[langcode].split(",")[0].encode('utf-8')
+        return True, language in m.group(1)
     else:
-        return False
+        return False, False
 
 
-def text_from_xmlfile(infile):
+def text_from_xml(intext):
     text_lines = []
-    with open(infile, 'r', encoding='utf-8') as fin:
-        for line in fin:
-            if line.startswith(('<', ' ')):
-                continue
-            stripped_line = line.strip(linestrip_pattern)
-            if stripped_line:
-                text_lines.append(stripped_line + "\n")
-    return ''.join(text_lines)
+    for line in intext.splitlines():
+        if line[:1] in (b"<", b" "):
+            continue
+        stripped_line = line.strip(linestrip_bytes)
+        if linestrip_multibyte and (
+                stripped_line.startswith(linestrip_multibyte)
+                or stripped_line.endswith(linestrip_multibyte)):
+            stripped_line = (linestrip_bytes_regex.fullmatch(stripped_line)
+                             .group(1))
+        if stripped_line:
+            text_lines.append(stripped_line)
+    if not text_lines:
+        return b""
+    return b"\n".join(text_lines) + b"\n"
 
 
 def batched(iterable, batch_size: int):
@@ -324,22 +455,116 @@ def batched(iterable, batch_size: int):
         if not batch:
             return
         yield batch
+        # drop the reference before the next batch is read
+        del batch
 
 
 def chunked_reader(file_path, lines_per_chunk):
-    with open(file_path, "r", encoding='utf-8') as f:
-        for chunk in batched(f, lines_per_chunk):
-            yield chunk
+    with open(file_path, "r", encoding='utf-8', buffering=1024*1024) as f:
+        yield from batched(f, lines_per_chunk)
      
             
-def check_line_count(file_path):
-    with open(file_path, 'br') as f:
-        nlines = sum(1 for i in f)
-    if nlines == 0:
+def open_lines_reader(file_path, column):
+    # Streams the lines of a text file as Arrow record batches with one
+    # string column. The file is memory-mapped and read as CSV without
+    # quoting, using a delimiter that should not occur in subtitle text.
+    # Lines that do contain it can not be read this way and are skipped.
+    n_skipped = 0
+    def skip_row(row):
+        nonlocal n_skipped
+        n_skipped += 1
+        return "skip"
+    with pa.memory_map(file_path) as source:
+        yield from pa.csv.open_csv(
+            source,
+            read_options=pa.csv.ReadOptions(column_names=[column],
+                                            block_size=1<<27),
+            parse_options=pa.csv.ParseOptions(delimiter="\x01",
+                                              quote_char=False,
+                                              ignore_empty_lines=False,
+                                              invalid_row_handler=skip_row),
+            convert_options=pa.csv.ConvertOptions(
+                column_types={column: pa.string()}))
+    if n_skipped:
+        print(f"   skipped {n_skipped} lines containing '\\x01'")
+
+
+def sentence_batches(parsedfile, source_data_type):
+    for batch in open_lines_reader(parsedfile, "sentence"):
+        lines = batch.column(0)
+        if source_data_type == "raw":
+            # linestrip_pattern was already applied while parsing
+            yield pc.utf8_trim_whitespace(lines)
+        else:
+            yield pc.utf8_trim(lines, characters=linestrip_pattern)
+
+
+def count_min_sketch(batches, cap):
+    """Return Count-Min sketch of the values in 'batches'.
+    Each row holds counters that saturate at 'cap'. A value's count is
+    estimated as the minimum of its counters, which is never lower than
+    its true count (or 'cap').
+    """
+    # one byte per counter unless 'cap' does not fit
+    dtype = np.min_scalar_type(cap)
+    sketch = np.zeros(count_min_sketch_shape, dtype=dtype)
+    for values in batches:
+        counts = pc.value_counts(values)
+        weights = np.minimum(counts.field("counts").to_numpy(), cap)
+        for row, idx in zip(sketch, sketch_indices(counts.field("values"))):
+            # sum the weights per counter first, as a counter can be hit
+            # by several values
+            counters, inverse = np.unique(idx, return_inverse=True)
+            sums = np.bincount(inverse, weights=weights)
+            row[counters] = np.minimum(row[counters] + sums, cap)
+    return sketch
+
+
+def sketch_estimate(sketch, values):
+    return np.min([row[idx] for row, idx
+                   in zip(sketch, sketch_indices(values))], axis=0)
+
+
+def sketch_indices(values):
+    # one 64-bit hash per value, combined into one index per sketch row
+    # (double hashing)
+    depth, width = count_min_sketch_shape
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    h = pd.util.hash_array(values.to_numpy(zero_copy_only=False))
+    h1 = h % np.uint64(width)
+    h2 = (h >> np.uint64(32)) % np.uint64(width)
+    return [((h1 + np.uint64(i)*h2) % np.uint64(width)).astype(np.int64)
+            for i in range(depth)]
+
+
+def value_counts(values, column):
+    counts = pc.value_counts(values)
+    return pa.table({column: counts.field("values"),
+                     "count": counts.field("counts")})
+
+
+def empty_counts(column):
+    return pa.table({column: pa.array([], pa.string()),
+                     "count": pa.array([], pa.int64())})
+
+
+def merge_counts(tables, column):
+    merged = (pa.concat_tables(tables)
+              .group_by(column)
+              .aggregate([("count", "sum")]))
+    return pa.table({column: merged[column], "count": merged["count_sum"]})
+
+
+def check_file_size(file_path):
+    # The number of lines is only known after counting, reading the whole
+    # file just to report it up front would take as long as reading it again.
+    size = os.path.getsize(file_path)
+    if size == 0:
         print(f"   No lines to process.")
     else:
-        print(f"   processing {nlines} lines...")
-    return nlines
+        print(f"   processing {size/1e6:.0f} MB of lines...")
+    return size
 
 
 def parsedfile_to_top_sentences(parsedfile, outfile,
@@ -349,171 +574,170 @@ def parsedfile_to_top_sentences(parsedfile, outfile,
     # Chunking is faster once the tmpfile is too large to fit in RAM
     # and only slightly slower when it fits in RAM.
     # The below section takes around 5min with 'es' and all years.
-    if not os.path.exists("bld/top_sentences"):
-        os.makedirs("bld/top_sentences")
-    nlines = check_line_count(parsedfile)
-    if nlines == 0:
+    os.makedirs("bld/top_sentences", exist_ok=True)
+    if check_file_size(parsedfile) == 0:
         return
 
-    d = Counter()
-    chunks_done = 0
-    for lines in chunked_reader(parsedfile, lines_per_chunk):
-        if source_data_type != "raw":
-            lines = [l.strip(linestrip_pattern) for l in lines]
-        d.update(lines)
-        chunks_done += 1
-        print(f"   {chunks_done * min(nlines, lines_per_chunk)} " +
-                "lines done")
-            
-    count_time = time.perf_counter() - start
-    print(f"   Done counting sentences in {count_time:.1f} seconds")
-
-    # remove empty entries
-    d.pop(None, None)
-    d.pop("", None)
-    
     # remove punctuation and numbers
     # remove 'sentences' starting with parenthesis
     # remove 'sentences' ending with colon
     # remove entries with latin characters
-    punctuation_and_numbers_regex = r"^[ _\W0-9]+$"
-    parenthesis_start_regex = r"^[(\[{]"
-    colon_end_regex = r":$"
     pattern = "|".join([punctuation_and_numbers_regex,
                       parenthesis_start_regex, colon_end_regex])    
     if langcode in non_latin_langs:
-        latin_regex = "[a-zA-Zà-üÀ-Ü]"
         pattern = "|".join([pattern, latin_regex])
-    d = Counter({k:v for (k, v) in d.items()
-                 if (not re.search(pattern, k))})
 
-    # save total counts
-    if os.path.exists(total_counts_sentences_file):
-        total_counts = (pd.read_csv(total_counts_sentences_file)
-                        .to_dict('records'))[0]
-    else:
-        total_counts = dict()
-    total_counts[langcode] = sum(d.values())
-    (pd.DataFrame(total_counts, index=[0])
-     .to_csv(total_counts_sentences_file, index=False))
-    
+    # first pass over the file with approximate counts, see Info
+    use_prefilter = min_count_prefilter and min_count
+    if use_prefilter:
+        sketch = count_min_sketch(sentence_batches(parsedfile,
+                                                   source_data_type),
+                                  min_count)
+        print(f"   Done prefiltering in {time.perf_counter()-start:.1f} "
+              + "seconds")
+
+    # Lines are counted per block with Arrow and the partial counts are
+    # merged every 'lines_per_chunk' lines, so no Python object is created
+    # per line. Filtering is done per block already, to get the total count
+    # before entries are dropped by the prefilter.
+    d = empty_counts("sentence")
+    partial_counts = []
+    total_count = 0
+    lines_done = 0
+    lines_in_chunk = 0
+    for lines in sentence_batches(parsedfile, source_data_type):
+        counts = value_counts(lines, "sentence")
+        # remove empty entries and those matching pattern
+        counts = counts.filter(pc.and_(
+            pc.not_equal(counts["sentence"], ""),
+            pc.invert(pc.match_substring_regex(counts["sentence"], pattern))))
+        total_count += pc.sum(counts["count"]).as_py() or 0
+        if use_prefilter:
+            counts = counts.filter(pa.array(
+                sketch_estimate(sketch, counts["sentence"]) >= min_count))
+        partial_counts.append(counts)
+        lines_in_chunk += len(lines)
+        if lines_in_chunk >= lines_per_chunk:
+            d = merge_counts([d] + partial_counts, "sentence")
+            partial_counts = []
+            lines_done += lines_in_chunk
+            lines_in_chunk = 0
+            print(f"   {lines_done} lines done")
+    d = merge_counts([d] + partial_counts, "sentence")
+    lines_done += lines_in_chunk
+            
+    count_time = time.perf_counter() - start
+    print(f"   Done counting sentences in {count_time:.1f} seconds "
+          + f"({lines_done} lines)")
+
     # remove less common items to save memory
     if not (min_count == None or min_count == 0):
-        d = Counter({key:value for key, value in d.items()
-                      if value >= min_count})
-
-    # "/n" is still at the end of every sentence
-    if source_data_type == "raw":
-        d = Counter({k.strip(): v for (k, v) in d.items()})
-    # this takes the same time as instead running below:
-    # d['sentence'] = d['sentence'].str.strip()
-
-    # TODO try doing everything in a dictionary instead of using pandas
-    d = pd.DataFrame(d.most_common(), columns=['sentence', 'count'])
-    d['count'] = pd.to_numeric(d['count'],
-                               downcast="unsigned") # saves ~50% memory
-    d = d.astype({"sentence":"string[pyarrow]"}) # saves ~66% memory
+        d = d.filter(pc.greater_equal(d["count"], min_count))
 
     d = collapse_if_only_ending_differently(d, "sentence", "count")
 
     try:
-        d = d[~d['sentence'].isin(extra_sentences_to_exclude()[langcode])]
+        # columns of unequal length are padded with NaN
+        exclude = [s for s in extra_sentences_to_exclude()[langcode]
+                   if isinstance(s, str)]
+        d = d.filter(pc.invert(pc.is_in(d["sentence"],
+                                        value_set=pa.array(exclude,
+                                                           pa.string()))))
     except KeyError as e:
         print("   no extra sentences to exclude")
     
-    (d
-     .head(n_top_sentences)
-     .to_csv(outfile, index=False))
+    write_top_csv(d, outfile, n_top_sentences)
+    return total_count
+
+
+def write_top_csv(table, outfile, n_top):
+    # Writes the first 'n_top' rows in the same format as DataFrame.to_csv.
+    # (pyarrow's csv writer would put quotes around every string.)
+    top = table.slice(0, n_top)
+    with open(outfile, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(top.column_names)
+        writer.writerows(zip(*(top[c].to_pylist() for c in top.column_names)))
 
     
-def collapse_if_only_ending_differently(df, sentence, count):
-    return (df
-            .sort_values(by=[count], ascending=False)
-            .assign(Sm1=df[sentence].str.strip(" .?!¿¡"))
-            .groupby('Sm1', as_index=False)
-            .agg({sentence:'first', count:'sum'})
-            .drop(columns=['Sm1'])
-            .sort_values(by=[count], ascending=False)
-            .reset_index(drop=True))
+def collapse_if_only_ending_differently(table, sentence, count):
+    return collapse_by_key(table,
+                           pc.utf8_trim(table[sentence],
+                                        characters=" .?!¿¡"),
+                           sentence, count)
+
+
+def collapse_by_key(table, keys, entry, count):
+    """Return table with one row per distinct value in 'keys'.
+    The counts of all entries with the same key are summed and the most
+    common of these entries is kept. Sorted by count, descending.
+    Ties are ordered by entry, so the result does not depend on the order
+    of the rows in 'table'.
+    """
+    table = (table
+             .append_column("key", keys)
+             .sort_by([(count, "descending"), (entry, "ascending")]))
+    table = table.append_column("row", pa.array(np.arange(len(table))))
+    grouped = (table
+               .group_by("key")
+               .aggregate([("row", "min"), (count, "sum")]))
+    return (pa.table({entry: pc.take(table[entry], grouped["row_min"]),
+                      count: grouped[f"{count}_sum"]})
+            .sort_by([(count, "descending"), (entry, "ascending")]))
 
 
 def parsedfile_to_top_words(parsedfile, outfile, langcode, source_data_type):
     print("Getting top words:")
     start = time.perf_counter()
-    if not os.path.exists("bld/top_words"):
-        os.makedirs("bld/top_words")       
-    nlines = check_line_count(parsedfile)
-    if nlines == 0:
+    os.makedirs("bld/top_words", exist_ok=True)
+    if check_file_size(parsedfile) == 0:
         return
-    d = Counter()
-    chunks_done = 0
-    with ProcessPoolExecutor(max_workers=n_process) as executor:
+    d = empty_counts("word")
+    lines_done = 0
+    with multiprocessing.Pool(n_process, initializer=init_count_words_worker,
+                              initargs=(langcode,)) as pool:
         for lines in chunked_reader(parsedfile, lines_per_chunk):
-            tokenized_lines = tokenize_lines_mp(lines, langcode, executor)
-            d.update(tokenized_lines)
-            chunks_done += 1
-            print(f"   {chunks_done * min(nlines, lines_per_chunk)} "
-                    + "lines done")
+            n_lines = len(lines)
+            d = merge_counts([d] + count_words_mp(lines, langcode, pool),
+                             "word")
+            # free this chunk before the next one is read, so that at most
+            # one chunk of lines is held in memory
+            del lines
+            lines_done += n_lines
+            print(f"   {lines_done} lines done")
             # 6 min per 10,000,000 lines ("nl" has 107,000,000 lines) 
             
     count_time = time.perf_counter() - start
     print(f"   Done tokenizing lines and counting words in {count_time:.1f} seconds")         
     
-    # remove empty entries
-    d.pop("", None)
-    d.pop(None, None)
+    # remove empty entries (null entries are dropped by the filter as well)
+    d = d.filter(pc.not_equal(d["word"], ""))
     
     # remove punctuation and numbers
     # remove entries with latin characters
-    punctuation_and_numbers_regex = r"^[ _\W0-9]+$"
     pattern = punctuation_and_numbers_regex
     if langcode in non_latin_langs:
-        latin_regex = "[a-zA-Zà-üÀ-Ü]"
         pattern = "|".join([pattern, latin_regex])
-    d = Counter({k:v for (k, v) in d.items() if not
-                 re.search(pattern, k)})
+    d = d.filter(pc.invert(pc.match_substring_regex(d["word"], pattern)))
 
-    # save total counts
-    if os.path.exists(total_counts_words_file):
-        total_counts = (pd.read_csv(total_counts_words_file)
-                        .to_dict('records'))[0]
-    else:
-        total_counts = dict()
-    total_counts[langcode] = sum(d.values())
-    (pd.DataFrame(total_counts, index=[0])
-     .to_csv(total_counts_words_file, index=False))
+    total_count = pc.sum(d["count"]).as_py() or 0
     
     # remove less common items to save memory
     if not (min_count == None or min_count == 0):
-        d = Counter({key:value for key, value in d.items()
-                      if value >= min_count})
+        d = d.filter(pc.greater_equal(d["count"], min_count))
 
-    d = pd.DataFrame(d.most_common(), columns=['word', 'count'])
-    d['count'] = pd.to_numeric(d['count'],
-                               downcast="unsigned") # saves ~50% memory
-    d = d.astype({"word":"string[pyarrow]"}) # saves ~66% memory
-
-    d = collapse_case(d, "word", "count", "wordlow", lowcase_cutoff)
+    d = collapse_case(d, "word", "count", lowcase_cutoff)
     
     #TODO add more cleaning steps from google-books-ngram-frequency repo
     
-    (d
-     .head(n_top_words)
-     .to_csv(outfile, index=False))
-
+    write_top_csv(d, outfile, n_top_words)
+    return total_count
 
-current_spacy = None
-current_spacy_langcode = None
 
 def get_spacy_pipeline(langcode):
     
-    global current_spacy, current_spacy_langcode
-    
     lang_code_normalized = normalized_langcode(langcode)
     
-    if current_spacy and current_spacy_langcode == lang_code_normalized:
-        return current_spacy
-    
     import spacy
     
     model_mapping = {
@@ -533,9 +757,6 @@ def get_spacy_pipeline(langcode):
     else:
         nlp = spacy.blank(lang_code_normalized)
         
-    current_spacy = nlp
-    current_spacy_langcode = lang_code_normalized
-        
     return nlp
 
 
@@ -561,19 +782,27 @@ def join_to_min_length(strings, n: int):
         yield ' '.join(current_words)
         
 
-def tokenize_lines(lines: list, langcode: str, get_spacy_pipeline):
+def uses_spacy_tokenizer(langcode):
+    return not (source_data_type == "tokenized" or use_regex_tokenizer
+                or normalized_langcode(langcode) in langs_not_in_spacy)
+
+
+def tokenize_lines(lines: list, langcode: str, nlp):
     if source_data_type == "text":
         lines = (l.strip(linestrip_pattern) for l in lines)
     if source_data_type == "tokenized":
         # no tokenizer needed
         dt = [l.strip(linestrip_pattern).split(" ") for l in lines]
-    elif (use_regex_tokenizer
-          or normalized_langcode(langcode) in langs_not_in_spacy):
-        # use regex tokenizer
-        dt = [re.findall(regex_tokenizer_pattern, l) for l in lines]
+    elif not uses_spacy_tokenizer(langcode):
+        # use regex tokenizer, with a single scan over all lines of the
+        # batch (assumes 'regex_tokenizer_pattern' never matches a newline)
+        dt = [tokenizer_regex.findall("\n".join(lines))]
     else:
         # use spacy tokenizer
-        nlp = get_spacy_pipeline(langcode)
+        # The pipeline is loaded once per worker process (see
+        # init_count_words_worker). Not using nlp.pipe(n_process=...) over
+        # the whole file instead: spaCy then sends every Doc back to the main
+        # process, which made tokenizing and counting ~3x as costly.
         big_lines = join_to_min_length(lines, 5_000)
         dt = [
             [w.text.strip("-") for w in doc if not w.is_punct]
@@ -582,12 +811,29 @@ def tokenize_lines(lines: list, langcode: str, get_spacy_pipeline):
         
     return dt
 
-def tokenize_lines_mp(lines, langcode, executor: ProcessPoolExecutor):
+worker_nlp = None
+
+def init_count_words_worker(langcode):
+    # Runs once in each worker process of the pool, so that the spacy
+    # pipeline is only loaded once per worker and never pickled.
+    global worker_nlp
+    if uses_spacy_tokenizer(langcode):
+        worker_nlp = get_spacy_pipeline(langcode)
+
+
+def count_words(lines: list, langcode: str):
+    # Counting within the worker means only the distinct words of a batch
+    # and their counts are sent back, instead of every token.
+    dt = tokenize_lines(lines, langcode, worker_nlp)
+    words = pa.array(list(itertools.chain.from_iterable(dt)), pa.string())
+    return value_counts(words, "word")
+
+
+def count_words_mp(lines, langcode, pool: multiprocessing.pool.Pool):
 
     lines_batched = batched(lines, int(lines_per_chunk/(n_process*25)))
-    tokenize_func = partial(tokenize_lines, langcode=langcode, get_spacy_pipeline=get_spacy_pipeline)
-    dt = itertools.chain.from_iterable(executor.map(tokenize_func, lines_batched))  
-    return itertools.chain.from_iterable(dt)
+    count_func = partial(count_words, langcode=langcode)
+    return list(pool.imap_unordered(count_func, lines_batched, chunksize=4))
 
 
 def normalized_langcode(langcode):
@@ -597,45 +843,29 @@ def normalized_langcode(langcode):
         return langcode.split("_")[0]
 
 
-def collapse_case(df, word, count, wordlow, cutoff=0.5):
-    if cutoff == 0.5:
-        return (df
-                .sort_values(by=[count], ascending=False)
-                .assign(wordlow=df[word].str.lower())
-                .groupby(wordlow, as_index=False)
-                .agg({word:'first', count:'sum'})
-                .drop(columns=[wordlow])
-                .sort_values(by=[count], ascending=False)
-                .reset_index(drop=True))
-    else:
-        return (df
-                .assign(wordlow=df["word"].str.lower())
-                .groupby(wordlow, as_index=False)
-                .apply(wordcase_by_cutoff, word, count, wordlow, cutoff)
-                .drop(columns=[wordlow])
-                .sort_values(by=[count], ascending=False)
-                .reset_index(drop=True))
-
-
-def wordcase_by_cutoff(df, word, count, wordlow, cutoff):
-    """Return series of word case and count based on a cutoff value.
-    If it exists, the lowercase version of 'word' is returned as long
-    as its share of all words in 'df' is larger than 'cutoff'.
-    Else the most common version is returned.
+def collapse_case(table, word, count, cutoff=0.5):
+    """Return table with the counts of all cases of a word summed.
+    If it exists, the lowercase version of a word is kept as long as its
+    share of the summed count is larger than 'cutoff'.
+    Else the most common version is kept.
     """
-    group_count = sum(df[count])
-    share = df[count]/group_count
-    is_low = df[word] == df[wordlow]
-    if (is_low & (share > cutoff)).any():
-        return pd.Series([df.loc[(is_low & (share > cutoff)).idxmax(), wordlow],
-                          group_count], index=[word, count])
-    else:
-        return pd.Series([df.loc[share.idxmax(), word],
-                          group_count], index=[word, count])
+    words_low = pc.utf8_lower(table[word])
+    d = collapse_by_key(table, words_low, word, count)
+    # look up the count of the lowercase version of each word, if any
+    is_low = pc.equal(table[word], words_low)
+    low = table.filter(is_low)
+    keys = pc.utf8_lower(d[word])
+    low_count = (pc.take(low[count], pc.index_in(keys, value_set=low[word]))
+                 .fill_null(0).to_numpy())
+    use_low = low_count / d[count].to_numpy() > cutoff
+    return d.set_column(d.column_names.index(word), word,
+                        pc.if_else(pa.array(use_low), keys, d[word]))
 
 
 def run_one_langcode(langcode, source_data_type):
+    """Return total counts of sentences and words (None if not counted)."""
     t0 = time.time()
+    n_sentences = n_words = None
     check_cwd()
     print("\nLanguage:", langcode)
     if get_source_data:
@@ -656,26 +886,32 @@ def run_one_langcode(langcode, source_data_type):
                                     tmpfile(langcode),
                                     year_min, year_max)
     if get_sentences:
-
-        parsedfile_to_top_sentences(parsedfile(langcode, source_data_type),
-                                    sentence_outfile(langcode),
-                                    langcode, source_data_type)
+        n_sentences = parsedfile_to_top_sentences(
+            parsedfile(langcode, source_data_type),
+            sentence_outfile(langcode),
+            langcode, source_data_type)
     if get_words:
         if not get_words_using_tokenized:
-            parsedfile_to_top_words(parsedfile(langcode, source_data_type),
-                                    word_outfile(langcode),
-                                    langcode,
-                                    source_data_type)
+            n_words = parsedfile_to_top_words(
+                parsedfile(langcode, source_data_type),
+                word_outfile(langcode),
+                langcode,
+                source_data_type)
         else:
-            parsedfile_to_top_words(parsedfile(langcode, "tokenized"),
-                                    word_outfile(langcode),
-                                    langcode,
-                                    "tokenized")
+            n_words = parsedfile_to_top_words(
+                parsedfile(langcode, "tokenized"),
+                word_outfile(langcode),
+                langcode,
+                "tokenized")
     if delete_tmpfile:
         if os.path.exists(tmpfile(langcode)):
             os.remove(tmpfile(langcode))
-            if not os.listdir("bld/tmp"):
-                os.rmdir(f"bld/tmp")
+            # other languages running in parallel may still need bld/tmp
+            if n_parallel_langcodes == 1 and not os.listdir("bld/tmp"):
+                try:
+                    os.rmdir("bld/tmp")
+                except OSError:
+                    pass
     if delete_source_data:
         if source_data_type == "raw" and not always_keep_raw_data:
             if os.path.exists(rawdatadir(langcode)):
@@ -691,6 +927,7 @@ def run_one_langcode(langcode, source_data_type):
                 os.rmdir(f"basedatadir/{langcode}")
     t1 = time.time()
     print(f"Total time (s): {t1-t0:.1f}\n")
+    return n_sentences, n_words
 
 
 def check_cwd():
@@ -711,35 +948,82 @@ def check_langcodes(langcodes):
             raise Exception(f"Error: Not a valid langcode: {langcode}")
 
 
+def load_total_counts(file_path, read_legacy=False):
+    if os.path.exists(file_path):
+        # one "langcode<tab>count" line per language, later lines win
+        with open(file_path, encoding='utf-8') as f:
+            return {l: int(n) for l, n in (line.split("\t") for line in f)}
+    # total counts used to be saved as a one-row csv file
+    legacy_file_path = os.path.splitext(file_path)[0] + ".csv"
+    if read_legacy and os.path.exists(legacy_file_path):
+        return {l: int(n) for l, n
+                in pd.read_csv(legacy_file_path).iloc[0].items()}
+    return dict()
+
+
+def write_total_count(f, langcode, total_count):
+    if total_count is not None:
+        f.write(f"{langcode}\t{total_count}\n".encode())
+        # keep the counts of finished languages if a later one fails
+        f.flush()
+
+
+def write_total_counts(sentences_f, words_f, langcodes, results):
+    for langcode, (n_sentences, n_words) in zip(langcodes, results):
+        write_total_count(sentences_f, langcode, n_sentences)
+        write_total_count(words_f, langcode, n_words)
+
+
 def summary_table(langcodes):
-    sc = pd.read_csv(total_counts_sentences_file)
-    wc = pd.read_csv(total_counts_words_file)
+    sc = load_total_counts(total_counts_sentences_file, read_legacy=True)
+    wc = load_total_counts(total_counts_words_file, read_legacy=True)
+    st = pd.DataFrame({"code": langcodes})
+    st["language"] = pd.Series(languages).reindex(st["code"]).values
+    st["sentences"] = pd.Series(sc).reindex(st["code"]).values
+    st["words"] = pd.Series(wc).reindex(st["code"]).values
+    if parquet_summary_table:
+        # keeps the counts as integers, for reading the table back in
+        st.to_parquet("bld/summary_table.parquet", index=False,
+                      compression="zstd")
     if md_summary_table:
-        (pd.DataFrame({"code": langcodes})
-         .assign(language=[languages[l] for l in st['code']])
-         .assign(sentences=[f"[{sc[l][0]:,}]({sentence_outfile(l)})"
-                            for l in st['code']])
-         .assign(words=[f"[{wc[l][0]:,}]({word_outfile(l)})"
-                        for l in st['code']])
-         .to_markdown("bld/summary_table.md", index=False,
-                      colalign=["left", "left", "right", "right"]))
+        from tabulate import tabulate
+        sentences = ("[" + st["sentences"].map("{:,}".format) + "]("
+                     + st["code"].map(sentence_outfile) + ")")
+        words = ("[" + st["words"].map("{:,}".format) + "]("
+                 + st["code"].map(word_outfile) + ")")
+        with open("bld/summary_table.md", 'w', encoding='utf-8') as f:
+            f.write(tabulate(zip(st["code"], st["language"], sentences, words),
+                             headers=list(st.columns), tablefmt="pipe",
+                             colalign=["left", "left", "right", "right"]))
     else:
-        (pd.DataFrame({"code": langcodes})
-         .assign(language=[languages[l] for l in st['code']])
-         .assign(sentences=[sc[l][0] for l in st['code']])
-         .assign(words=[wc[l][0] for l in st['code']])
-         .to_csv("bld/summary_table.csv", index=False))
+        with open("bld/summary_table.csv", 'w', encoding='utf-8',
+                  newline='') as f:
+            writer = csv.writer(f, lineterminator=os.linesep)
+            writer.writerow(st.columns)
+            writer.writerows(st.itertuples(index=False))
 
 
 def main():
     check_langcodes(run_langcodes)
     check_cwd()
-    if os.path.exists(total_counts_sentences_file):
-            os.remove(total_counts_sentences_file)
-    if os.path.exists(total_counts_words_file):
-            os.remove(total_counts_words_file)
-    for langcode in run_langcodes:
-        run_one_langcode(langcode, source_data_type)
+    for total_counts_file in [total_counts_sentences_file,
+                              total_counts_words_file]:
+        try:
+            os.remove(total_counts_file)
+        except FileNotFoundError:
+            pass
+    # languages are run in worker processes if 'n_parallel_langcodes' > 1,
+    # the total counts are saved here as each of them finishes
+    run = partial(run_one_langcode, source_data_type=source_data_type)
+    with open(total_counts_sentences_file, 'ab') as sentences_f, \
+         open(total_counts_words_file, 'ab') as words_f:
+        if n_parallel_langcodes > 1:
+            with ProcessPoolExecutor(n_parallel_langcodes) as executor:
+                write_total_counts(sentences_f, words_f, run_langcodes,
+                                   executor.map(run, run_langcodes))
+        else:
+            write_total_counts(sentences_f, words_f, run_langcodes,
+                               map(run, run_langcodes))
     if get_summary_table:
         summary_table(run_langcodes)
 